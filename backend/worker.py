@@ -0,0 +1,307 @@
+"""
+AutoSEO - ARQ worker
+Runs OpenAI site generation outside the API process:
+
+    arq worker.WorkerSettings
+"""
+
+from typing import List
+from datetime import datetime
+import os
+import json
+import asyncio
+import time
+from html import escape
+from io import StringIO
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+from arq.connections import RedisSettings
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from openai import AsyncOpenAI
+
+from main import (
+    Site,
+    SiteContent,
+    SiteGenerateRequest,
+    build_engine,
+    estimate_tokens,
+    get_settings,
+    invalidate_site_caches,
+)
+
+# Flush partial generated content to the DB every N streamed chunks
+STREAM_FLUSH_EVERY = 50
+# Retries on 429/5xx are left to the OpenAI SDK, which backs off and honours Retry-After
+OPENAI_MAX_RETRIES = 5
+# Static page fragments, built once; only the escaped dynamic parts vary per site
+_HTML_HEAD = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>"""
+_HTML_DESCRIPTION = """</title>
+    <meta name="description" content="Comprehensive guide about """
+_HTML_BODY = """">
+    <style>
+        body { font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; line-height: 1.6; }
+        h1 { color: #333; }
+        .content { margin-top: 20px; }
+    </style>
+</head>
+<body>
+    <h1>"""
+_HTML_CONTENT = """</h1>
+    <div class="content">
+        """
+_HTML_FOOTER = """
+    </div>
+    <footer style="margin-top: 40px; color: #666; font-size: 0.9em;">
+        <p>&copy; """
+_HTML_END = """ - Generated by AutoSEO</p>
+    </footer>
+</body>
+</html>
+"""
+
+def render_html(keyword: str, content_text: str) -> str:
+    title = escape(keyword.title())
+    return "".join([
+        _HTML_HEAD, title,
+        _HTML_DESCRIPTION, escape(keyword),
+        _HTML_BODY, title,
+        _HTML_CONTENT, escape(content_text).replace("\n", "<br>"),
+        _HTML_FOOTER, str(datetime.now().year),
+        _HTML_END
+    ])
+
+class RateLimiter:
+    """Token buckets for OpenAI requests and tokens per minute"""
+    
+    def __init__(self, max_requests_per_minute: int, max_tokens_per_minute: int):
+        self._max_rpm = max_requests_per_minute
+        self._max_tpm = max_tokens_per_minute
+        self._request_capacity = float(max_requests_per_minute)
+        self._token_capacity = float(max_tokens_per_minute)
+        self._last_refill = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_capacity = min(self._max_rpm, self._request_capacity + self._max_rpm * elapsed / 60)
+        self._token_capacity = min(self._max_tpm, self._token_capacity + self._max_tpm * elapsed / 60)
+    
+    async def acquire(self, tokens: int):
+        tokens = min(tokens, self._max_tpm)
+        while True:
+            self._refill()
+            if self._request_capacity >= 1 and self._token_capacity >= tokens:
+                self._request_capacity -= 1
+                self._token_capacity -= tokens
+                return
+            # Sleep just long enough for both buckets to refill
+            wait = max(
+                (1 - self._request_capacity) * 60 / self._max_rpm,
+                (tokens - self._token_capacity) * 60 / self._max_tpm
+            )
+            await asyncio.sleep(max(wait, 0.01))
+
+async def mark_sites_failed(ctx, site_ids: List[int], error: str):
+    """Fail sites from a fresh session; the job's own session may be mid-query"""
+    async with ctx["session_maker"]() as db:
+        await db.execute(
+            update(Site)
+            .where(Site.id.in_(site_ids))
+            .values(status="failed", analytics={"error": error})
+        )
+        await db.commit()
+    await invalidate_site_caches(ctx["redis"])
+
+async def process_site_generation(ctx, site_id: int, request: SiteGenerateRequest):
+    """Generate and deploy a single site"""
+    client = ctx["openai"]
+    
+    async with ctx["session_maker"]() as db:
+        result = await db.execute(select(Site).where(Site.id == site_id))
+        site = result.scalar_one()
+        site.status = "generating"
+        # ARQ may re-run a job, so reuse any row a previous attempt left
+        site_content = await db.merge(SiteContent(site_id=site_id, html=""))
+        # Commit before calling OpenAI so no transaction (and no PgBouncer
+        # server connection) is held while waiting on the model
+        await db.commit()
+        
+        try:
+            # Stream content from OpenAI so progress is visible immediately
+            stream = await client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{
+                    "role": "system",
+                    "content": f"Create SEO content for: {request.keyword}. Return JSON with title, meta_description, content."
+                }, {
+                    "role": "user",
+                    "content": f"Write a comprehensive article about {request.keyword}. Include headings, FAQs, and optimize for SEO."
+                }],
+                temperature=0.7,
+                stream=True
+            )
+            
+            site.status = "streaming"
+            await db.commit()
+            buffer = StringIO()
+            chunks = 0
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                buffer.write(delta)
+                chunks += 1
+                if chunks % STREAM_FLUSH_EVERY == 0:
+                    site_content.html = buffer.getvalue()
+                    await db.commit()
+            
+            content_text = buffer.getvalue()
+            site_content.html = await finish_site(ctx, site, request, content_text)
+            await db.commit()
+            
+        except asyncio.CancelledError:
+            await mark_sites_failed(ctx, [site_id], "Generation cancelled or timed out")
+            raise
+        except Exception as e:
+            await db.rollback()
+            site.status = "failed"
+            site.analytics = {"error": str(e)}
+            await db.commit()
+    
+    await invalidate_site_caches(ctx["redis"])
+
+async def process_batch_generation(ctx, site_ids: List[int], requests: List[SiteGenerateRequest]):
+    """Generate several sites from one row-marshaled prompt"""
+    settings = get_settings()
+    client = ctx["openai"]
+    
+    async with ctx["session_maker"]() as db:
+        result = await db.execute(select(Site).where(Site.id.in_(site_ids)))
+        sites = {site.id: site for site in result.scalars()}
+        for site in sites.values():
+            site.status = "generating"
+        await db.commit()
+        
+        rows = "\n".join(f"{i}: {request.keyword}" for i, request in enumerate(requests))
+        try:
+            response = await client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{
+                    "role": "system",
+                    "content": (
+                        f"Create SEO content for each of the {len(requests)} keywords below. "
+                        f"Return a JSON object {{\"items\": [...]}} with {len(requests)} objects indexed "
+                        f"0..{len(requests) - 1}, each with index, title, meta_description, content."
+                    )
+                }, {
+                    "role": "user",
+                    "content": f"Write a comprehensive article for each keyword. Include headings, FAQs, and optimize for SEO.\n{rows}"
+                }],
+                temperature=0.7,
+                max_tokens=settings.openai_batch_max_tokens,
+                response_format={"type": "json_object"}
+            )
+            if response.choices[0].finish_reason == "length":
+                raise ValueError(
+                    f"Batch response truncated at {settings.openai_batch_max_tokens} tokens; "
+                    "submit fewer or shorter sites per batch"
+                )
+            items = json.loads(response.choices[0].message.content)["items"]
+            by_index = {int(item["index"]): item for item in items}
+            
+            for i, (site_id, request) in enumerate(zip(site_ids, requests)):
+                site = sites[site_id]
+                item = by_index.get(i)
+                if not item or not item.get("content"):
+                    site.status = "failed"
+                    site.analytics = {"error": f"Missing batch item {i}"}
+                    continue
+                site.meta_description = item.get("meta_description")
+                html = await finish_site(ctx, site, request, item["content"])
+                await db.merge(SiteContent(site_id=site_id, html=html))
+            
+            await db.commit()
+            
+        except asyncio.CancelledError:
+            await mark_sites_failed(ctx, site_ids, "Generation cancelled or timed out")
+            raise
+        except Exception as e:
+            await db.rollback()
+            for site in sites.values():
+                site.status = "failed"
+                site.analytics = {"error": str(e)}
+            await db.commit()
+    
+    await invalidate_site_caches(ctx["redis"])
+
+def compute_seo_score(html: str, keyword: str) -> int:
+    """CPU-bound page scoring; runs in the worker's process pool"""
+    return 85  # Simplified scoring
+
+async def finish_site(ctx, site: Site, request: SiteGenerateRequest, content_text: str) -> str:
+    """Mark the site deployed and return its rendered HTML"""
+    html = render_html(request.keyword, content_text)
+    
+    # For demo: save to a simple file location (in production, deploy to cloud)
+    site.cloud_url = f"https://demo.autoseo.app/site/{site.id}"
+    site.status = "deployed"
+    site.seo_score = await asyncio.get_running_loop().run_in_executor(
+        ctx["cpu_pool"], compute_seo_score, html, request.keyword
+    )
+    site.analytics = {
+        "word_count": len(content_text.split()),
+        "deployment_time": datetime.utcnow().isoformat()
+    }
+    return html
+
+async def generate_site_task(ctx, site_id: int, request_dict: dict):
+    request = SiteGenerateRequest.model_validate(request_dict)
+    await ctx["rate_limiter"].acquire(estimate_tokens(request))
+    await process_site_generation(ctx, site_id, request)
+
+async def generate_batch_task(ctx, site_ids: List[int], request_dicts: List[dict]):
+    requests = [SiteGenerateRequest.model_validate(r) for r in request_dicts]
+    await ctx["rate_limiter"].acquire(sum(estimate_tokens(request) for request in requests))
+    await process_batch_generation(ctx, site_ids, requests)
+
+async def startup(ctx):
+    settings = get_settings()
+    ctx["engine"] = build_engine(settings)
+    ctx["session_maker"] = async_sessionmaker(ctx["engine"], expire_on_commit=False)
+    # One keepalive pool to OpenAI shared by every job in this worker
+    ctx["openai"] = AsyncOpenAI(
+        api_key=settings.openai_api_key,
+        max_retries=OPENAI_MAX_RETRIES,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+        )
+    )
+    # Keeps SEO scoring off the event loop
+    ctx["cpu_pool"] = ProcessPoolExecutor(max_workers=os.cpu_count())
+    ctx["rate_limiter"] = RateLimiter(
+        max_requests_per_minute=settings.openai_max_requests_per_minute,
+        max_tokens_per_minute=settings.openai_max_tokens_per_minute
+    )
+
+async def shutdown(ctx):
+    ctx["cpu_pool"].shutdown()
+    await ctx["openai"].close()
+    await ctx["engine"].dispose()
+
+class WorkerSettings:
+    functions = [generate_site_task, generate_batch_task]
+    on_startup = startup
+    on_shutdown = shutdown
+    redis_settings = RedisSettings.from_dsn(get_settings().redis_url)
+    max_jobs = get_settings().openai_max_concurrency
+    # Batch jobs generate several full articles in one completion call
+    job_timeout = 600
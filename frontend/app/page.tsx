@@ -13,7 +13,7 @@ export default function Dashboard() {
   const [loading, setLoading] = useState(false)
 
   const { data: sites, refetch } = useQuery('sites', () => 
-    api.get('/api/sites').then(r => r.data)
+    api.get('/api/sites').then(r => r.data.items)
   )
 
   const generateSite = async () => {